@@ -1,17 +1,134 @@
+import argparse
+import hashlib
 import os
+import shutil
 import subprocess
+import tempfile
 import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
-start_time = time.time()
 
-with open("output.txt", "w") as f:
-    order = "stp --SMTLIB2 ./smt2/midori.smt2 --threads 30 --cryptominisat  -n"
-    s = os.popen(order).read()
-    f.write(s)
+def output_files(smt2_files):
+    """Return a distinct output file for each SMT2 file."""
+    # a single run keeps the output.txt of the original workflow
+    if len(smt2_files) == 1:
+        return ["output.txt"]
+    names = [os.path.splitext(os.path.basename(p))[0] for p in smt2_files]
+    counts = Counter(names)
+    # files of the same name in different directories get their position
+    return [
+        f"output_{name}_{i}.txt" if counts[name] > 1 else f"output_{name}.txt"
+        for i, name in enumerate(names)
+    ]
 
-end_time = time.time()
 
-total_time = end_time - start_time
+def solve(smt2_file, output_file, threads, timeout, cache_dir=None):
+    """Run STP on one SMT2 file, write its output and return the run time.
 
-with open("time.log", "w") as f:
-    f.write(f"Total execution time: {total_time} seconds\n")
+    The returned flag tells whether the output was taken from the cache.
+    """
+    start_time = time.time()
+
+    # an unchanged SMT2 file has the same answer, reuse the earlier output
+    cache_file = None
+    if cache_dir:
+        with open(smt2_file, "rb") as f:
+            digest = hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+        cache_file = os.path.join(cache_dir, f"{digest}.txt")
+        if os.path.exists(cache_file):
+            shutil.copyfile(cache_file, output_file)
+            return smt2_file, time.time() - start_time, True
+
+    with open(output_file, "w") as f:
+        order = [
+            "stp",
+            "--SMTLIB2",
+            smt2_file,
+            "--threads",
+            str(threads),
+            "--cryptominisat",
+            "-n",
+        ]
+        # STP writes straight into the file, nothing is buffered here
+        process = subprocess.Popen(order, stdout=f)
+        try:
+            process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+            f.write("timeout\n")
+
+    # timeouts and crashes are not answers, only cache finished runs
+    if cache_file and process.returncode == 0:
+        os.makedirs(cache_dir, exist_ok=True)
+        # copy to a temporary file first and rename it, so a crash or another
+        # worker with the same content never leaves a truncated entry, at most
+        # a stray .tmp file that is never read
+        fd, tmp_file = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+        os.close(fd)
+        shutil.copyfile(output_file, tmp_file)
+        os.replace(tmp_file, cache_file)
+
+    return smt2_file, time.time() - start_time, False
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Solve S-box SMT2 files with STP.")
+    parser.add_argument(
+        "smt2", nargs="*", default=["./smt2/midori.smt2"], help="SMT2 files to solve"
+    )
+    parser.add_argument("--threads", type=int, default=30, help="threads per STP")
+    parser.add_argument(
+        "--timeout", type=float, default=None, help="seconds before STP is killed"
+    )
+    parser.add_argument(
+        "--cache-dir", default=None, help="reuse STP outputs of unchanged files"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=None, help="STP processes run at once"
+    )
+    args = parser.parse_args()
+
+    if args.threads < 1:
+        parser.error("--threads must be at least 1")
+    if args.workers is not None and args.workers < 1:
+        parser.error("--workers must be at least 1")
+
+    outputs = output_files(args.smt2)
+    if len(set(outputs)) < len(outputs):
+        parser.error("the SMT2 files do not map to distinct output files")
+
+    # split the cores between the STP processes, more solver threads than
+    # cores only adds synchronization overhead in the SAT solver
+    workers = min(args.workers or len(args.smt2), len(args.smt2))
+    threads = min(args.threads, max(1, (os.cpu_count() or 1) // workers))
+    print(f"Running {workers} STP processes with {threads} threads each")
+
+    start_time = time.time()
+
+    # the files are independent, run one STP per file at the same time
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(
+            executor.map(
+                lambda smt2_file, output_file: solve(
+                    smt2_file, output_file, threads, args.timeout, args.cache_dir
+                ),
+                args.smt2,
+                outputs,
+            )
+        )
+
+    end_time = time.time()
+
+    total_time = end_time - start_time
+
+    with open("time.log", "w") as f:
+        for (smt2_file, run_time, cached), output_file in zip(results, outputs):
+            if cached:
+                f.write(f"{smt2_file} ({output_file}) cached\n")
+            else:
+                f.write(
+                    f"{smt2_file} ({output_file}) execution time: {run_time} seconds\n"
+                )
+        f.write(f"Total execution time: {total_time} seconds\n")
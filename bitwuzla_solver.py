@@ -1,3 +1,9 @@
+import argparse
+import re
+import sys
+import time
+from functools import lru_cache
+
 from bitwuzla import *
 
 # First, create a term manager instance.
@@ -12,131 +18,272 @@ bitwuzla = Bitwuzla(tm, options)
 bits = 4
 bit_with = 2**bits
 gate_number = 20
-# XOR, AND, OR, NOT
-gts = [0b0110, 0b001, 0b0111, 0b1100]
+# AND, OR, XOR, NOT, the gate type is the index into this list
+gts = ["AND", "OR", "XOR", "NOT"]
 # this is the sbox, it is temp used, after need generate by the true sbox
 xs = [0x00FF, 0x0F0F, 0x3333, 0x5555]
 ys = [0xF4A4, 0x32AB, 0x6077, 0x1735]
 
-sortbv = tm.mk_bv_sort(bit_with)
 
-# create the input and output variables
-xs_v = [tm.mk_const(sortbv, "x{}".format(i)) for i in range(bits)]
-ys_v = [tm.mk_const(sortbv, "y{}".format(i)) for i in range(bits)]
+# sorts and constants are looked up in the gate loops, create each only once
+@lru_cache(maxsize=None)
+def bv_sort(width):
+    """Return the bitvector sort of the given width."""
+    return tm.mk_bv_sort(width)
 
-# create the constraints
-for i in range(bits):
-    bitwuzla.assert_formula(
-        tm.mk_term(Kind.EQUAL, [xs_v[i], tm.mk_bv_value(sortbv, xs[i])])
-    )
-for i in range(bits):
-    bitwuzla.assert_formula(
-        tm.mk_term(Kind.EQUAL, [ys_v[i], tm.mk_bv_value(sortbv, ys[i])])
+
+@lru_cache(maxsize=None)
+def bv_value(value, width=bit_with):
+    """Return the bitvector constant of the given value and width."""
+    return tm.mk_bv_value(bv_sort(width), value)
+
+
+sortbv = bv_sort(bit_with)
+
+# the sbox inputs and outputs are known, use the constants directly
+xs_v = [bv_value(x) for x in xs]
+ys_v = [bv_value(y) for y in ys]
+
+
+def mux(sel, sources, bit):
+    """Select sources[sel] with an ite tree over the bits 0..bit of sel."""
+    if len(sources) == 1:
+        return sources[0]
+    half = 1 << bit
+    if len(sources) <= half:
+        return mux(sel, sources, bit - 1)
+    sel_bit = tm.mk_term(Kind.BV_EXTRACT, [sel], [bit, bit])
+    return tm.mk_term(
+        Kind.ITE,
+        [
+            tm.mk_term(Kind.EQUAL, [sel_bit, bv_value(1, 1)]),
+            mux(sel, sources[half:], bit - 1),
+            mux(sel, sources[:half], bit - 1),
+        ],
     )
 
+
 # create the gate input and output
 ts_v = [tm.mk_const(sortbv, "t{}".format(i)) for i in range(gate_number)]
-qs_v = [tm.mk_const(sortbv, "q{}".format(i)) for i in range(gate_number * 2)]
-# create the constraints for the input
+# each gate input is an index into the sbox inputs and the earlier gate
+# outputs, instead of a free variable equal to one of them
+sels_v = []
+qs_v = []
 for i in range(gate_number):
-    input0 = [tm.mk_term(Kind.EQUAL, [qs_v[2 * i], xs_v[j]]) for j in range(bits)]
-    input1 = [tm.mk_term(Kind.EQUAL, [qs_v[2 * i + 1], xs_v[j]]) for j in range(bits)]
-    inter0 = [tm.mk_term(Kind.EQUAL, [qs_v[2 * i], ts_v[j]]) for j in range(i)]
-    inter1 = [tm.mk_term(Kind.EQUAL, [qs_v[2 * i + 1], ts_v[j]]) for j in range(i)]
-    bitwuzla.assert_formula(tm.mk_term(Kind.OR, input0 + inter0))
-    bitwuzla.assert_formula(tm.mk_term(Kind.OR, input1 + inter1))
+    sources = xs_v + ts_v[:i]
+    width = max(1, (len(sources) - 1).bit_length())
+    sortsel = bv_sort(width)
+    for k in range(2):
+        sel = tm.mk_const(sortsel, "sel{}".format(2 * i + k))
+        if len(sources) < 1 << width:
+            bitwuzla.assert_formula(
+                tm.mk_term(Kind.BV_ULT, [sel, bv_value(len(sources), width)])
+            )
+        sels_v.append(sel)
+        qs_v.append(mux(sel, sources, width - 1))
+    # AND, OR and XOR are commutative and NOT only reads the first input, so
+    # the inputs can be kept in index order
+    bitwuzla.assert_formula(tm.mk_term(Kind.BV_ULE, [sels_v[-2], sels_v[-1]]))
 
-# need encoding for gate type
-gts_v = [tm.mk_const(sortbv, "gt{}".format(i)) for i in range(gate_number)]
+# need encoding for gate type, a 2-bit selector covers the four types so no
+# domain constraint is needed
+gts_v = [tm.mk_const(bv_sort(2), "gt{}".format(i)) for i in range(gate_number)]
 
-# create the constraints for the gate type
-for i in range(gate_number):
-    types = [
-        tm.mk_term(Kind.EQUAL, [gts_v[i], tm.mk_bv_value(sortbv, gts[j])])
-        for j in range(len(gts))
-    ]
-    bitwuzla.assert_formula(tm.mk_term(Kind.OR, types))
+# the term of each gate type, built from its two inputs
+gate_ops = {
+    "AND": lambda q0, q1: tm.mk_term(Kind.BV_AND, [q0, q1]),
+    "OR": lambda q0, q1: tm.mk_term(Kind.BV_OR, [q0, q1]),
+    "XOR": lambda q0, q1: tm.mk_term(Kind.BV_XOR, [q0, q1]),
+    "NOT": lambda q0, q1: tm.mk_term(Kind.BV_NOT, [q0]),
+}
 
 # create the constraints for the output, it is the hard part.
-one_sort = tm.mk_bv_sort(1)
-one = tm.mk_bv_value(one_sort, 1)
-zores = tm.mk_bv_value(sortbv, 0)
-ones = tm.mk_bv_value(sortbv, 2**bit_with - 1)
 for i in range(gate_number):
-    # create the constraints for the output
-    gt0 = tm.mk_term(Kind.BV_EXTRACT, [gts_v[i]], [0, 0])
-    gt1 = tm.mk_term(Kind.BV_EXTRACT, [gts_v[i]], [1, 1])
-    gt2 = tm.mk_term(Kind.BV_EXTRACT, [gts_v[i]], [2, 2])
-    gt3 = tm.mk_term(Kind.BV_EXTRACT, [gts_v[i]], [3, 3])
-    gt0_ul = tm.mk_term(
-        Kind.ITE,
-        [
-            tm.mk_term(Kind.BV_ULT, [gt0, one]),
-            zores,
-            tm.mk_term(Kind.BV_AND, [qs_v[2 * i], qs_v[2 * i + 1]]),
-        ],
+    q0 = qs_v[2 * i]
+    q1 = qs_v[2 * i + 1]
+    # the gate type indexes the results in the order of gts
+    gate_outs = [gate_ops[gt](q0, q1) for gt in gts]
+    gate_out = mux(gts_v[i], gate_outs, 1)
+    bitwuzla.assert_formula(tm.mk_term(Kind.EQUAL, [ts_v[i], gate_out]))
+    # NOT ignores its second input, tie it to the first one so that a gate
+    # only read there does not count as live below
+    is_not = tm.mk_term(Kind.EQUAL, [gts_v[i], bv_value(gts.index("NOT"), 2)])
+    same_input = tm.mk_term(Kind.EQUAL, [sels_v[2 * i], sels_v[2 * i + 1]])
+    bitwuzla.assert_formula(tm.mk_term(Kind.IMPLIES, [is_not, same_input]))
+
+# create the constraints for the sbox output link the gate output, each sbox
+# output is an index into the gate outputs like the gate inputs above
+ksel_width = max(1, (gate_number - 1).bit_length())
+ksels_v = [tm.mk_const(bv_sort(ksel_width), "ksel{}".format(i)) for i in range(bits)]
+for i in range(bits):
+    if gate_number < 1 << ksel_width:
+        bitwuzla.assert_formula(
+            tm.mk_term(Kind.BV_ULT, [ksels_v[i], bv_value(gate_number, ksel_width)])
+        )
+    bitwuzla.assert_formula(
+        tm.mk_term(Kind.EQUAL, [ys_v[i], mux(ksels_v[i], ts_v, ksel_width - 1)])
     )
-    gt1_ul = tm.mk_term(
-        Kind.ITE,
-        [
-            tm.mk_term(Kind.BV_ULT, [gt1, one]),
-            zores,
-            qs_v[2 * i + 1],
-        ],
+
+# the pick and read terms do not depend on the gate count, create them once
+# and only slice them per count: picks[i][j] is ksel_i = j, reads[i] are the
+# later selectors pointing at t_i
+picks = [
+    [
+        tm.mk_term(Kind.EQUAL, [ksel, bv_value(j, ksel_width)])
+        for j in range(gate_number)
+    ]
+    for ksel in ksels_v
+]
+reads = [
+    [
+        tm.mk_term(Kind.EQUAL, [sel, bv_value(bits + i, sel.sort().bv_size())])
+        for sel in sels_v[2 * (i + 1) :]
+    ]
+    for i in range(gate_number)
+]
+
+
+def assert_gate_count(gates):
+    """Restrict the circuit to its first gates, no gate of them is dead."""
+    # the sbox outputs may only pick the first gates
+    for ksel in ksels_v:
+        bitwuzla.assert_formula(
+            tm.mk_term(Kind.BV_ULE, [ksel, bv_value(gates - 1, ksel_width)])
+        )
+    # no dead gates, every gate feeds a later gate or an sbox output
+    for i in range(gates):
+        uses = [picks[k][i] for k in range(bits)]
+        uses += reads[i][: 2 * (gates - i - 1)]
+        bitwuzla.assert_formula(tm.mk_term(Kind.OR, uses))
+
+
+def format_circuit(sels, gate_types, ksels, gates):
+    """Return the lines of the circuit given by the selector and type values."""
+
+    def source(sel):
+        return f"X{sel}" if sel < bits else f"T{sel - bits}"
+
+    lines = []
+    for i in range(gates):
+        a, b = source(sels[2 * i]), source(sels[2 * i + 1])
+        gate = gts[gate_types[i]]
+        if gate == "NOT":
+            lines.append(f"T{i} = NOT {a}")
+        else:
+            lines.append(f"T{i} = {a} {gate} {b}")
+    for i, ksel in enumerate(ksels):
+        lines.append(f"Y{i} = T{ksel}")
+    return lines
+
+
+# a model line of the STP answer, the name may be quoted in |...|
+MODEL_RE = re.compile(
+    r"define-fun\s+\|?(\w+)\|?\s+\(\)\s+\(_ BitVec \d+\)\s+(#b[01]+|#x[0-9A-Fa-f]+)"
+)
+
+
+def decode_answer(answer_file):
+    """Return the circuit lines of an STP answer to the --smt2 export.
+
+    None is returned when the answer holds no model, e.g. unsat or timeout.
+    """
+    values = {}
+    with open(answer_file, "r") as f:
+        if f.readline().strip() != "sat":
+            return None
+        for line in f:
+            match = MODEL_RE.search(line)
+            if match:
+                name, value = match.groups()
+                values[name] = int(value[2:], 2 if value[1] == "b" else 16)
+    if not values:
+        return None
+    # the answer has a model, a variable STP left out of it can take any
+    # value, read it as 0
+    return format_circuit(
+        [values.get(f"sel{i}", 0) for i in range(2 * gate_number)],
+        [values.get(f"gt{i}", 0) for i in range(gate_number)],
+        [values.get(f"ksel{i}", 0) for i in range(bits)],
+        gate_number,
     )
-    gt2_ul = tm.mk_term(
-        Kind.ITE,
-        [
-            tm.mk_term(Kind.BV_ULT, [gt2, one]),
-            zores,
-            qs_v[2 * i],
-        ],
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Search the smallest circuit of the S-box with Bitwuzla."
     )
-    gt3_ul = tm.mk_term(
-        Kind.ITE,
-        [
-            tm.mk_term(Kind.BV_ULT, [gt3, one]),
-            zores,
-            ones,
-        ],
+    parser.add_argument(
+        "--dump-assertions", action="store_true", help="print the circuit assertions"
     )
-    bitwuzla.assert_formula(
-        tm.mk_term(
-            Kind.EQUAL,
-            [
-                ts_v[i],
-                tm.mk_term(
-                    Kind.BV_XOR,
-                    [
-                        gt0_ul,
-                        tm.mk_term(
-                            Kind.BV_XOR,
-                            [gt1_ul, tm.mk_term(Kind.BV_XOR, [gt2_ul, gt3_ul])],
-                        ),
-                    ],
-                ),
-            ],
-        )
+    parser.add_argument(
+        "--smt2",
+        help="write the simplified formula to this file for STP, no search, "
+        "read the answer back with --decode",
     )
-# create the constraints for the sbox output link the gate output
-for i in range(bits):
-    ts_temp = [tm.mk_term(Kind.EQUAL, [ys_v[i], ts_v[j]]) for j in range(gate_number)]
-    bitwuzla.assert_formula(tm.mk_term(Kind.OR, ts_temp))
+    parser.add_argument(
+        "--decode", help="print the circuit of an STP answer to the --smt2 export"
+    )
+    args = parser.parse_args()
 
-assertions = bitwuzla.get_assertions()
-print("Assertions:")
-print("{")
-for a in assertions:
-    print(f" {a}")
-print("}")
+    if args.decode:
+        circuit = decode_answer(args.decode)
+        if circuit is None:
+            sys.exit(f"{args.decode}: no model, the answer is not sat")
+        print("\n".join(circuit))
+        sys.exit(0)
 
-import time
+    if args.dump_assertions:
+        assertions = bitwuzla.get_assertions()
+        print("Assertions:")
+        print("{")
+        for a in assertions:
+            print(f" {a}")
+        print("}")
+
+    if args.smt2:
+        # let the Bitwuzla rewriter shrink the formula before STP bit-blasts it
+        assert_gate_count(gate_number)
+        bitwuzla.simplify()
+        smt2 = bitwuzla.print_formula()
+        with open(args.smt2, "w") as f:
+            f.write(smt2.replace("(exit)", "(get-model)\n(exit)"))
+        sys.exit(0)
+
+    # search the gate count incrementally, the circuit is built once for
+    # gate_number gates and a smaller count only restricts the sbox outputs to
+    # the first gates, so the solver keeps what it learned between the checks.
+    # every distinct sbox output needs its own gate, fewer gates are unsat
+    # without asking the solver
+    min_gates = len(set(ys))
+    start_time = time.time()
+    times = []
+    circuit = None
+    for gates in range(gate_number, min_gates - 1, -1):
+        bitwuzla.push(1)
+        assert_gate_count(gates)
+        check_time = time.time()
+        result = bitwuzla.check_sat()
+        times.append((gates, result, time.time() - check_time))
+        # the model is gone after pop, keep the circuit of the smallest count
+        if result == Result.SAT:
+            circuit = format_circuit(
+                [int(bitwuzla.get_value(sel).value(10)) for sel in sels_v],
+                [int(bitwuzla.get_value(gt).value(10)) for gt in gts_v],
+                [int(bitwuzla.get_value(ksel).value(10)) for ksel in ksels_v],
+                gates,
+            )
+        bitwuzla.pop(1)
+        if result != Result.SAT:
+            break
+    end_time = time.time()
 
-start_time = time.time()
-result = bitwuzla.check_sat()
-end_time = time.time()
+    total_time = end_time - start_time
 
-total_time = end_time - start_time
+    with open("time_bitwuzla.log", "w") as f:
+        for gates, result, check_time in times:
+            f.write(f"Gates {gates}: {result} in {check_time} seconds\n")
+        f.write(f"Total execution time: {total_time} seconds\n")
 
-with open("time_bitwuzla.log", "w") as f:
-    f.write(f"Total execution time: {total_time} seconds\n")
+    if circuit:
+        with open("circuit_bitwuzla.txt", "w") as f:
+            f.write("\n".join(circuit) + "\n")